@@ -0,0 +1,31 @@
+"""Measure per-block execute_py cost as the store grows.
+
+Run with: python benchmarks/bench_namespace.py
+
+Namespace setup doesn't depend on the number of stored names, so the
+per-block time should stay flat across store sizes. Blocks run through
+_execute_py so the memo doesn't turn every repeat into a lookup.
+"""
+
+from timeit import timeit
+
+from markdown_math_solver import Expr, store
+from markdown_math_solver.solver import _execute_py
+
+BLOCKS = 20000
+
+
+def main():
+    print(f"{'stored names':>12}  {'us/block':>8}")
+    for size in (0, 100, 1000, 5000, 20000):
+        store.clear()
+        for i in range(size):
+            store[f"v{i}"] = Expr(str(i))
+        store["x"] = Expr("1+2")
+        seconds = timeit(lambda: _execute_py("ReplaceThis(str(x))", ""), number=BLOCKS)
+        print(f"{size:>12}  {seconds / BLOCKS * 1e6:>8.2f}")
+    store.clear()
+
+
+if __name__ == "__main__":
+    main()
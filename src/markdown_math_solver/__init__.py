@@ -7,12 +7,20 @@ from .solver import (
     ReplaceThis,
     ReplaceAll,
     NoOutput,
+    Store,
     store,
+    include,
     find_py_block,
     execute_py,
+    memo_stats,
+    reset_memo_stats,
     fmt,
+    solve_system,
     process_block,
     process_markdown,
+    add_hook,
+    remove_hook,
+    MetricsCollector,
 )
 
 __all__ = [
@@ -20,10 +28,18 @@ __all__ = [
     "ReplaceThis",
     "ReplaceAll",
     "NoOutput",
+    "Store",
     "store",
+    "include",
     "find_py_block",
     "execute_py",
+    "memo_stats",
+    "reset_memo_stats",
     "fmt",
+    "solve_system",
     "process_block",
     "process_markdown",
+    "add_hook",
+    "remove_hook",
+    "MetricsCollector",
 ]
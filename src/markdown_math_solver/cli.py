@@ -25,6 +25,12 @@ def main():
         default=None,
         help="Output file path (default: <input>.output.md)",
     )
+    parser.add_argument(
+        "-j", "--jobs",
+        type=int,
+        default=1,
+        help="Process independent blocks on this many worker processes (default: 1)",
+    )
     parser.add_argument(
         "-v", "--version",
         action="version",
@@ -44,7 +50,7 @@ def main():
     store.clear()
 
     content = path.read_text(encoding="utf-8")
-    result = process_markdown(content)
+    result = process_markdown(content, base_dir=path.parent, jobs=args.jobs)
 
     if args.output:
         out = Path(args.output)
@@ -1,19 +1,775 @@
 """Core solver logic for Markdown Math Solver."""
 
 import re
+import sys
+import ast
+import builtins
+import itertools
+import copy
+import json
+import bisect
+import hashlib
+import weakref
+from time import perf_counter
+from functools import lru_cache
+from collections import ChainMap, OrderedDict
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from sympy.parsing.latex import parse_latex
-from sympy import Symbol, solve
+from sympy import Basic, Symbol, latex as sympy_latex, preorder_traversal, solve, sympify
+from sympy import Set, linear_eq_to_matrix, linsolve, nonlinsolve, nsolve
+from sympy.solvers.solveset import NonlinearError
+
+try:
+    import numpy as np
+except ImportError:  # Matrix evaluation is optional
+    np = None
+
+
+def _approx_size(value, depth=0):
+    """Approximate memory used by a stored value, in bytes"""
+    size = sys.getsizeof(value)
+    if isinstance(value, Expr):
+        size += sys.getsizeof(value._latex or "") + sys.getsizeof(value._original or "")
+        if isinstance(value._original_tree, Basic) and value._original_tree is not value._tree:
+            size += _approx_size(value._original_tree, depth + 1)
+        value = value._tree
+    if isinstance(value, Basic):
+        size += sum(sys.getsizeof(node) for node in preorder_traversal(value))
+    elif depth < 3 and isinstance(value, (list, tuple, set, frozenset)):
+        size += sum(_approx_size(v, depth + 1) for v in value)
+    elif depth < 3 and isinstance(value, dict):
+        size += sum(_approx_size(k, depth + 1) + _approx_size(v, depth + 1) for k, v in value.items())
+    return size
+
+
+# Source of store entry versions, unique across all stores
+_versions = itertools.count()
+# Every live Store, so they can re-measure Exprs that change after being set
+_stores = weakref.WeakValueDictionary()
+
+
+def _remeasure(expr):
+    """Update the size of every store entry holding expr after it changed"""
+    for s in list(_stores.values()):
+        s.remeasure(expr)
+
+
+class Store(dict):
+    """Stored expressions, with size accounting and optional LRU eviction
+
+    Each entry's approximate size is measured when it is set, and again
+    whenever a stored Expr is parsed or changed in place. If max_bytes is
+    set, the least recently used entries that the current document has not
+    referenced are evicted whenever the total exceeds it.
+    """
+
+    def __init__(self, *args, max_bytes=None, **kwargs):
+        super().__init__()
+        self.max_bytes = max_bytes
+        # name -> size, least recently used first
+        self._sizes = OrderedDict()
+        self._nbytes = 0
+        # Names referenced since begin_document(), never evicted
+        self._pinned = set()
+        # name -> version, renewed every time the name is set
+        self._versions = {}
+        # id(Expr) -> names it is stored under
+        self._names = {}
+        _stores[id(self)] = self
+        self.update(*args, **kwargs)
+
+    def __reduce__(self):
+        return self.__class__, (dict(self),), {"max_bytes": self.max_bytes}
+
+    def copy(self):
+        return self.__class__(dict(self), max_bytes=self.max_bytes)
+
+    __copy__ = copy
+
+    def __ior__(self, other):
+        self.update(other)
+        return self
+
+    @property
+    def nbytes(self):
+        """Approximate total size of all entries, in bytes"""
+        return self._nbytes
+
+    def begin_document(self):
+        """Start a new document: earlier references no longer protect entries"""
+        self._pinned.clear()
+
+    def version(self, key):
+        """Return the version of key, which changes whenever it is set"""
+        return self._versions.get(key)
+
+    def touch(self, key):
+        """Mark key as used by the current document"""
+        self._sizes.move_to_end(key)
+        self._pinned.add(key)
+
+    def remeasure(self, value):
+        """Measure the entries holding value again, after it changed in place"""
+        names = self._names.get(id(value))
+        if not names:
+            return
+        size = _approx_size(value)
+        for key in names:
+            self._nbytes += size - self._sizes[key]
+            self._sizes[key] = size
+        self._evict()
+
+    def __getitem__(self, key):
+        value = dict.__getitem__(self, key)
+        self.touch(key)
+        return value
+
+    def __setitem__(self, key, value):
+        size = _approx_size(value)
+        if key in self:
+            self._nbytes -= self._sizes[key]
+            self._forget(key)
+        dict.__setitem__(self, key, value)
+        if isinstance(value, Expr):
+            self._names.setdefault(id(value), set()).add(key)
+        self._versions[key] = next(_versions)
+        self._sizes[key] = size
+        self._nbytes += size
+        self.touch(key)
+        self._evict()
+
+    def __delitem__(self, key):
+        self._forget(key)
+        dict.__delitem__(self, key)
+        self._nbytes -= self._sizes.pop(key)
+        self._versions.pop(key)
+        self._pinned.discard(key)
+
+    def get(self, key, default=None):
+        return self[key] if key in self else default
+
+    def pop(self, key, *default):
+        if key not in self:
+            return dict.pop(self, key, *default)
+        value = dict.__getitem__(self, key)
+        del self[key]
+        return value
+
+    def popitem(self):
+        key = next(reversed(self))
+        self._forget(key)
+        value = dict.pop(self, key)
+        self._nbytes -= self._sizes.pop(key)
+        self._versions.pop(key)
+        self._pinned.discard(key)
+        return key, value
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return self[key]
+
+    def update(self, *args, **kwargs):
+        for k, v in dict(*args, **kwargs).items():
+            self[k] = v
+
+    def clear(self):
+        dict.clear(self)
+        self._sizes.clear()
+        self._versions.clear()
+        self._names.clear()
+        self._nbytes = 0
+        self._pinned.clear()
+
+    def _forget(self, key):
+        value = dict.__getitem__(self, key)
+        if isinstance(value, Expr):
+            names = self._names[id(value)]
+            names.discard(key)
+            if not names:
+                del self._names[id(value)]
+
+    def _evict(self):
+        if self.max_bytes is None or self._nbytes <= self.max_bytes:
+            return
+        for key in list(self._sizes):
+            if self._nbytes <= self.max_bytes:
+                break
+            if key not in self._pinned:
+                del self[key]
+
+
+store = Store()
+
+# Included documents, least recently used first: resolved path ->
+# (((path, content hash) of it and every file it includes), exported entries)
+_include_cache = OrderedDict()
+_INCLUDE_CACHE_SIZE = 64
+# Files read by the includes currently being evaluated (innermost last)
+_include_files = []
+# Directories of the documents currently being processed (innermost last)
+_base_dirs = []
+# Included files currently being evaluated, for cycle detection
+_including = set()
+
+# Instrumentation hooks, each called as hook(event, info)
+_hooks = []
+
+
+def add_hook(hook):
+    """Register an instrumentation hook.
+
+    hook(event, info) is called for every event, where event is one of
+    "block_start", "block_end", "statement", "parse", "evaluate", "solve",
+    "error", "memo_hit" or "memo_miss" and info is a dict identifying what
+    happened. "block_end", "statement", "parse", "evaluate" and "solve"
+    carry a "duration" in seconds; "error" carries the "error" and the
+    "statement" or "latex" it came from.
+    """
+    _hooks.append(hook)
+    return hook
+
+
+def remove_hook(hook):
+    """Unregister a hook added with add_hook"""
+    _hooks.remove(hook)
+
+
+def _emit(event, **info):
+    for hook in list(_hooks):
+        hook(event, info)
+
+
+class _Timed:
+    """Context manager that emits event with its duration on exit"""
+
+    def __init__(self, event, **info):
+        self.event = event
+        self.info = info
+
+    def __enter__(self):
+        self.start = perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.info["duration"] = perf_counter() - self.start
+        _emit(self.event, **self.info)
+        return False
+
+
+def _timed(event, fn, **info):
+    """Return fn(), emitting event with its duration if any hook is registered.
+
+    Info values may be given as callables, so they're only computed when
+    someone is listening.
+    """
+    if not _hooks:
+        return fn()
+    with _Timed(event, **_resolve(info)):
+        return fn()
+
+
+def _emit_error(e, **info):
+    """Report exception e to hooks as an error event, info as for _timed"""
+    if _hooks:
+        _emit("error", error=f"{type(e).__name__}: {e}", **_resolve(info))
+
+
+def _resolve(info):
+    """Compute the info values given as callables"""
+    return {k: v() if callable(v) else v for k, v in info.items()}
+
+
+class MetricsCollector:
+    """Hook that aggregates event counters and latency histograms
+
+    Register it with add_hook(), then export with to_prometheus() or
+    snapshot()/to_json().
+    """
+
+    BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0)
+
+    def __init__(self, buckets=None):
+        self.buckets = tuple(sorted(buckets)) if buckets else self.BUCKETS
+        self.counts = {}
+        # event -> per-bucket counts (last slot is +Inf), total duration
+        self._histograms = {}
+
+    def __call__(self, event, info):
+        self.counts[event] = self.counts.get(event, 0) + 1
+        duration = info.get("duration")
+        if duration is None:
+            return
+        hist = self._histograms.get(event)
+        if hist is None:
+            hist = self._histograms[event] = [[0] * (len(self.buckets) + 1), 0.0]
+        hist[0][bisect.bisect_left(self.buckets, duration)] += 1
+        hist[1] += duration
+
+    def reset(self):
+        self.counts.clear()
+        self._histograms.clear()
+
+    def snapshot(self):
+        """Return counters and cumulative histograms as a JSON-ready dict"""
+        histograms = {}
+        for event, (bucket_counts, total) in self._histograms.items():
+            cumulative, running = [], 0
+            for bound, n in zip(self.buckets + ("+Inf",), bucket_counts):
+                running += n
+                cumulative.append([bound, running])
+            histograms[event] = {"buckets": cumulative, "sum": total, "count": running}
+        return {"counts": dict(self.counts), "histograms": histograms}
+
+    def to_json(self):
+        return json.dumps(self.snapshot())
+
+    def to_prometheus(self, prefix="markdown_math_solver"):
+        """Return the metrics in Prometheus text exposition format"""
+        snap = self.snapshot()
+        lines = [f"# TYPE {prefix}_events_total counter"]
+        for event, n in sorted(snap["counts"].items()):
+            lines.append(f'{prefix}_events_total{{event="{event}"}} {n}')
+        lines.append(f"# TYPE {prefix}_duration_seconds histogram")
+        for event, hist in sorted(snap["histograms"].items()):
+            for bound, n in hist["buckets"]:
+                lines.append(f'{prefix}_duration_seconds_bucket{{event="{event}",le="{bound}"}} {n}')
+            lines.append(f'{prefix}_duration_seconds_sum{{event="{event}"}} {hist["sum"]}')
+            lines.append(f'{prefix}_duration_seconds_count{{event="{event}"}} {hist["count"]}')
+        return "\n".join(lines) + "\n"
+
+
+_PARAM_RE = re.compile(r"param\((\w+)\)")
+
+
+def _param_symbol(name):
+    """Symbol standing for an unbound param(name) inside a SymPy tree"""
+    return Symbol(f"param({name})")
+
+
+def _slot_name(i):
+    # parse_latex only accepts letters in \mathit{...}
+    return "paramslot" + "".join("abcdefghij"[int(d)] for d in str(i))
+
+
+class _Unparseable:
+    """Marks an Expr whose LaTeX SymPy can't parse"""
+
+    pass
+
 
-store = {}
+def _strip_text(latex):
+    """Remove \\text{...} groups, which carry no math"""
+    while "\\text{" in latex:
+        start = latex.find("\\text{")
+        depth, end = 1, start + 6
+        while depth > 0 and end < len(latex):
+            if latex[end] == "{":
+                depth += 1
+            elif latex[end] == "}":
+                depth -= 1
+            end += 1
+        latex = latex[:start] + latex[end:]
+    return latex
+
+
+def _evaluable_part(latex):
+    """Strip \\text{...} and keep only what follows the last ="""
+    clean = _strip_text(latex)
+    eq_idx = clean.rfind("=")
+    if eq_idx != -1:
+        clean = clean[eq_idx + 1 :]
+    return clean.strip()
+
+
+def _parse(latex):
+    """Parse the evaluable part of latex into a SymPy tree.
+
+    param(var) placeholders become param(var) symbols so they can later be
+    substituted at the tree level. Returns None if latex can't be parsed.
+    """
+    clean = _evaluable_part(latex)
+    if not clean:
+        return sympify(0)
+    names = []
+
+    def slot(m):
+        if m.group(1) not in names:
+            names.append(m.group(1))
+        return "\\mathit{" + _slot_name(names.index(m.group(1))) + "}"
+
+    clean = _PARAM_RE.sub(slot, clean)
+
+    def parse():
+        # Hand the exception back so only parse errors, not hook errors, are caught
+        try:
+            return parse_latex(clean)
+        except Exception as e:
+            return e
+
+    tree = _timed("parse", parse, latex=clean)
+    if isinstance(tree, Exception):
+        _emit_error(tree, latex=clean)
+        return None
+    return tree.xreplace({Symbol(_slot_name(i)): _param_symbol(n) for i, n in enumerate(names)})
+
+
+def _to_tree(value):
+    """Convert a bind/arithmetic operand to a SymPy tree, or None"""
+    if isinstance(value, Expr):
+        tree = value._sympy()
+        return tree if tree is not _Unparseable else None
+    if isinstance(value, Basic):
+        return value
+    if isinstance(value, (int, float)):
+        return sympify(value)
+    if isinstance(value, str):
+        return _parse(value)
+    return None
+
+
+# Text around param(var) that already sets off whatever replaces it
+_GROUP_OPEN = ("{", "(", "[", "=", ",", "&")
+_GROUP_CLOSE = ("}", ")", "]", "=", ",", "&")
+
+
+def _is_compound(text):
+    """Whether LaTeX text is signed or a sum at its top level"""
+    depth = 0
+    for c in text:
+        if c in "{([":
+            depth += 1
+        elif c in "})]":
+            depth -= 1
+        elif c in "+-" and depth == 0:
+            return True
+    return False
+
+
+def _bound_text(latex, var, value):
+    """Substitute the LaTeX of value for param(var) in latex, for display.
+
+    A signed value or a sum is grouped, unless the placeholder already
+    stands alone (a fraction part, one side of =) or is only added to.
+    """
+    text = str(value)
+    compound = _is_compound(text.strip())
+    signed = text.strip().startswith(("+", "-"))
+    parts = latex.split(f"param({var})")
+    result = parts[0]
+    for i, after in enumerate(parts[1:], 1):
+        before, after_ = result.rstrip(), after.lstrip()
+        if not after_ and i < len(parts) - 1:
+            # Another placeholder follows directly
+            after_ = "param"
+        alone = (not before or before.endswith(_GROUP_OPEN) or (not signed and before.endswith("+"))) and (
+            not after_ or after_.startswith(_GROUP_CLOSE + ("+", "-"))
+        )
+        result += (f"\\left({text}\\right)" if compound and not alone else text) + after
+    return result
+
+
+def _unbound_as_symbols(tree):
+    """Replace param(var) symbols with plain var symbols for evaluation"""
+    return tree.xreplace({s: Symbol(s.name[6:-1]) for s in tree.free_symbols if s.name.startswith("param(")})
+
+
+_MATRIX_RE = re.compile(r"\\begin\{([pbBvV]?matrix)\}")
+_COMMAND_RE = re.compile(r"\\([A-Za-z]+|.)")
+_NUMBER_RE = re.compile(r"\d*\.?\d+")
+_MATRIX_SPACING = {"\\,", "\\;", "\\:", "\\!", "\\ ", "\\quad", "\\qquad", "\\left", "\\right"}
+
+
+class _MatrixSyntaxError(ValueError):
+    """LaTeX the NumPy matrix evaluator doesn't understand"""
+
+    pass
+
+
+def _tokenize_matrix_expr(latex):
+    """Split LaTeX into matrix literals, numbers, commands and symbols"""
+    tokens = []
+    i = 0
+    while i < len(latex):
+        c = latex[i]
+        if c.isspace():
+            i += 1
+        elif latex.startswith("\\begin{", i):
+            m = _MATRIX_RE.match(latex, i)
+            if not m:
+                raise _MatrixSyntaxError(f"unsupported environment at {latex[i:i + 20]}")
+            end = latex.find(f"\\end{{{m.group(1)}}}", m.end())
+            if end == -1:
+                raise _MatrixSyntaxError(f"unterminated {m.group(1)}")
+            tokens.append(("matrix", m.group(1), latex[m.end() : end]))
+            i = end + len(m.group(1)) + 6
+        elif c == "\\":
+            m = _COMMAND_RE.match(latex, i)
+            if m is None:
+                raise _MatrixSyntaxError("trailing backslash")
+            if m.group(0) not in _MATRIX_SPACING:
+                tokens.append(("cmd", m.group(0)))
+            i = m.end()
+        elif c.isdigit() or c == ".":
+            m = _NUMBER_RE.match(latex, i)
+            if m is None:
+                raise _MatrixSyntaxError(f"stray . at {latex[i:i + 20]}")
+            tokens.append(("num", float(m.group(0))))
+            i = m.end()
+        else:
+            tokens.append(("sym", c))
+            i += 1
+    return tokens
+
+
+@lru_cache(maxsize=128)
+def _matrix_literal(env, body):
+    """Build a read-only NumPy array from the body of a matrix environment"""
+    rows = [row for row in body.split("\\\\") if row.strip()]
+    cells = [row.split("&") for row in rows]
+    if len({len(row) for row in cells}) > 1:
+        raise _MatrixSyntaxError("rows have different lengths")
+    array = np.array([[_matrix_cell(cell.strip()) for cell in row] for row in cells], dtype=float)
+    array.setflags(write=False)
+    return array
+
+
+def _matrix_cell(cell):
+    try:
+        return float(cell)
+    except ValueError:
+        value = _MatrixParser(cell).parse()
+        if isinstance(value, np.ndarray):
+            raise _MatrixSyntaxError("nested matrix")
+        return value
+
+
+def _matmul(a, b):
+    if isinstance(a, np.ndarray) and isinstance(b, np.ndarray):
+        return a @ b
+    return a * b
+
+
+def _add(a, b):
+    # NumPy would broadcast a scalar over every entry, which isn't matrix algebra
+    if isinstance(a, np.ndarray) != isinstance(b, np.ndarray):
+        raise _MatrixSyntaxError("adding a scalar to a matrix")
+    return a + b
+
+
+class _MatrixParser:
+    """Evaluates LaTeX matrix expressions with NumPy
+
+    expr   := ["-"] term (("+" | "-") term)*
+    term   := factor ([\\cdot | \\times] factor)*
+    factor := atom ("^" exponent)*
+    atom   := matrix | number | (expr) | {expr} | [expr] | |expr|
+              | \\frac{expr}{expr} | \\det atom | \\operatorname{tr} atom
+
+    Juxtaposed or multiplied matrices are matrix products; ^{-1}, ^{T} and
+    ^{n} are the inverse, transpose and matrix power.
+    """
+
+    def __init__(self, latex):
+        self.tokens = _tokenize_matrix_expr(latex)
+        self.pos = 0
+        # Environment of the first matrix literal, used to render results
+        self.env = None
+
+    def peek(self):
+        """Return the (kind, value) of the next token"""
+        return self.tokens[self.pos][:2] if self.pos < len(self.tokens) else (None, None)
+
+    def accept(self, kind, value):
+        if self.peek() == (kind, value):
+            self.pos += 1
+            return True
+        return False
+
+    def expect(self, kind, value):
+        if not self.accept(kind, value):
+            raise _MatrixSyntaxError(f"expected {value}")
+
+    def parse(self):
+        value = self.expr()
+        if self.pos != len(self.tokens):
+            raise _MatrixSyntaxError(f"unexpected {self.peek()[1]}")
+        return value
+
+    def expr(self):
+        value = -self.term() if self.accept("sym", "-") else self.term()
+        while True:
+            if self.accept("sym", "+"):
+                value = _add(value, self.term())
+            elif self.accept("sym", "-"):
+                value = _add(value, -self.term())
+            else:
+                return value
+
+    def term(self):
+        value = self.factor()
+        while True:
+            kind, token = self.peek()
+            if (kind, token) in (("cmd", "\\cdot"), ("cmd", "\\times"), ("sym", "*")):
+                self.pos += 1
+                value = _matmul(value, self.factor())
+            elif kind in ("matrix", "num") or (kind, token) in (("sym", "("), ("sym", "{"), ("sym", "["), ("cmd", "\\frac"), ("cmd", "\\det"), ("cmd", "\\operatorname")):
+                value = _matmul(value, self.factor())
+            elif self.accept("sym", "/"):
+                divisor = self.factor()
+                if isinstance(divisor, np.ndarray):
+                    raise _MatrixSyntaxError("division by a matrix")
+                value = value / divisor
+            else:
+                return value
+
+    def factor(self):
+        value = self.atom()
+        while self.accept("sym", "^"):
+            if self.accept("sym", "{"):
+                value = self.power(value)
+                self.expect("sym", "}")
+            else:
+                value = self.power(value)
+        return value
+
+    def power(self, value):
+        if self.accept("sym", "T") or self.accept("cmd", "\\top") or self.accept("cmd", "\\intercal"):
+            if not isinstance(value, np.ndarray):
+                raise _MatrixSyntaxError("transpose of a scalar")
+            return value.T
+        # A brace-less exponent is a single, optionally negated, atom: A^-1 + B
+        exponent = -self.atom() if self.accept("sym", "-") else self.atom()
+        if not isinstance(value, np.ndarray):
+            return value**exponent
+        if isinstance(exponent, np.ndarray) or exponent != int(exponent):
+            raise _MatrixSyntaxError("matrix powers must be integers")
+        if exponent == -1:
+            return np.linalg.inv(value)
+        return np.linalg.matrix_power(value, int(exponent))
+
+    def atom(self):
+        kind, token = self.peek()
+        self.pos += 1
+        if kind == "matrix":
+            env, body = token, self.tokens[self.pos - 1][2]
+            self.env = self.env or env
+            value = _matrix_literal(env, body)
+            # |...| environments are determinants
+            return np.linalg.det(value) if env in ("vmatrix", "Vmatrix") else value
+        if kind == "num":
+            return token
+        for open_, close in (("(", ")"), ("{", "}"), ("[", "]")):
+            if (kind, token) == ("sym", open_):
+                value = self.expr()
+                self.expect("sym", close)
+                return value
+        if (kind, token) == ("sym", "|"):
+            value = self.expr()
+            self.expect("sym", "|")
+            return np.linalg.det(value) if isinstance(value, np.ndarray) else abs(value)
+        if (kind, token) == ("cmd", "\\frac"):
+            self.expect("sym", "{")
+            numerator = self.expr()
+            self.expect("sym", "}")
+            self.expect("sym", "{")
+            denominator = self.expr()
+            self.expect("sym", "}")
+            if isinstance(denominator, np.ndarray):
+                raise _MatrixSyntaxError("division by a matrix")
+            return numerator / denominator
+        if (kind, token) == ("cmd", "\\det"):
+            return np.linalg.det(self.factor())
+        if (kind, token) == ("cmd", "\\operatorname"):
+            self.expect("sym", "{")
+            name = ""
+            while self.peek()[0] == "sym" and self.peek()[1] != "}":
+                name += self.peek()[1]
+                self.pos += 1
+            self.expect("sym", "}")
+            if name == "tr":
+                return np.trace(self.factor())
+            if name == "det":
+                return np.linalg.det(self.factor())
+        raise _MatrixSyntaxError(f"unsupported {token}")
+
+
+def _render_matrix(value, env):
+    """Render a NumPy result as LaTeX, formatting entries with fmt"""
+    if not isinstance(value, np.ndarray):
+        return float(value)
+    if env in (None, "vmatrix", "Vmatrix"):
+        env = "pmatrix"
+    # Round to fmt's precision first so round-off like -1e-17 shows as 0
+    value = np.round(np.atleast_2d(value), 6) + 0.0
+    rows = " \\\\ ".join(" & ".join(fmt(x) for x in row) for row in value)
+    return f"\\begin{{{env}}} {rows} \\end{{{env}}}"
+
+
+def _evaluate_matrix(latex):
+    """Evaluate a LaTeX expression containing matrix environments with NumPy.
+
+    Returns the rendered result, or None if the expression isn't something
+    the matrix evaluator understands.
+    """
+    try:
+        parser = _MatrixParser(latex)
+        value = parser.parse()
+    except _MatrixSyntaxError:
+        return None
+    except (np.linalg.LinAlgError, ValueError, ZeroDivisionError) as e:
+        _emit_error(e, latex=latex)
+        return f"[Error: {e}]"
+    return _render_matrix(value, parser.env)
 
 
 class Expr:
-    """Wrapper for LaTeX expressions with bind/call support"""
+    """Wrapper for LaTeX expressions with bind/call support
+
+    The parsed SymPy tree is cached, and arithmetic composes trees
+    directly, so composed expressions are never re-parsed. Expressions built
+    from trees only render their LaTeX when it is asked for.
+    """
 
     def __init__(self, latex, original=None, bindings=None):
-        self.latex = latex
+        self._latex = latex
         self._original = original if original is not None else latex
         self._bindings = bindings if bindings is not None else {}
+        # SymPy tree of the evaluable part, None until first parsed
+        self._tree = None
+        self._original_tree = None
+        # Bumped whenever bind() changes the expression in place
+        self._version = 0
+
+    @classmethod
+    def _from_tree(cls, tree):
+        expr = cls(None)
+        expr._original = None
+        expr._tree = tree
+        expr._original_tree = tree
+        return expr
+
+    @property
+    def latex(self):
+        if self._latex is None:
+            self._latex = sympy_latex(self._tree)
+        return self._latex
+
+    @latex.setter
+    def latex(self, value):
+        self._latex = value
+        self._tree = None
+        self._version += 1
+        _remeasure(self)
+
+    def _sympy(self):
+        if self._tree is None:
+            tree = _parse(self._latex)
+            self._tree = tree if tree is not None else _Unparseable
+            _remeasure(self)
+        return self._tree
 
     def __str__(self):
         return self.latex
@@ -21,22 +777,100 @@ class Expr:
     def __repr__(self):
         return self.latex
 
+    def _combine(self, other, op):
+        a = self._sympy()
+        b = _to_tree(other)
+        if a is _Unparseable or b is None:
+            return None
+        return Expr._from_tree(op(a, b))
+
     def __add__(self, other):
+        if not isinstance(other, str):
+            result = self._combine(other, lambda a, b: a + b)
+            if result is not None:
+                return result
         return self.latex + str(other)
 
     def __radd__(self, other):
+        if not isinstance(other, str):
+            result = self._combine(other, lambda a, b: b + a)
+            if result is not None:
+                return result
         return str(other) + self.latex
 
+    def __sub__(self, other):
+        result = self._combine(other, lambda a, b: a - b)
+        return result if result is not None else NotImplemented
+
+    def __rsub__(self, other):
+        result = self._combine(other, lambda a, b: b - a)
+        return result if result is not None else NotImplemented
+
+    def __mul__(self, other):
+        result = self._combine(other, lambda a, b: a * b)
+        return result if result is not None else NotImplemented
+
+    def __rmul__(self, other):
+        result = self._combine(other, lambda a, b: b * a)
+        return result if result is not None else NotImplemented
+
+    def __truediv__(self, other):
+        result = self._combine(other, lambda a, b: a / b)
+        return result if result is not None else NotImplemented
+
+    def __rtruediv__(self, other):
+        result = self._combine(other, lambda a, b: b / a)
+        return result if result is not None else NotImplemented
+
+    def __pow__(self, other):
+        result = self._combine(other, lambda a, b: a**b)
+        return result if result is not None else NotImplemented
+
+    def __rpow__(self, other):
+        result = self._combine(other, lambda a, b: b**a)
+        return result if result is not None else NotImplemented
+
+    def __neg__(self):
+        result = self._combine(-1, lambda a, b: a * b)
+        if result is not None:
+            return result
+        # Unparseable: negate the text, like + falls back to joining text
+        text = self.latex
+        return "-" + (f"\\left({text}\\right)" if _is_compound(text.strip()) else text)
+
     def bind(self, **kwargs):
-        result = self.latex
         new_bindings = dict(self._bindings)
-        for k, v in kwargs.items():
-            # Replace param(var) with value
-            result = result.replace(f"param({k})", str(v))
-            new_bindings[k] = v
+        new_bindings.update(kwargs)
+        # Substitute into the parsed tree, so bound values are never re-parsed
+        tree = self._sympy()
+        if tree is not _Unparseable:
+            if self._original_tree is None and self._latex == self._original:
+                self._original_tree = tree
+            for k, v in kwargs.items():
+                value = _to_tree(v)
+                if value is None:
+                    tree = _Unparseable
+                    break
+                tree = tree.xreplace({_param_symbol(k): value})
+        if tree is not _Unparseable and self._latex is None:
+            # Built from a tree: LaTeX is rendered from it
+            latex = None
+        else:
+            # The shown LaTeX has the values' text in place of param(var)
+            latex = self.latex
+            for k, v in kwargs.items():
+                latex = _bound_text(latex, k, v)
+        if tree is _Unparseable:
+            # Nothing to substitute into: evaluate the substituted text
+            tree = None
+        changed = tree is not self._tree or latex != self._latex
         # Update self in place so THIS() uses bound values
-        self.latex = result
+        self._tree = tree
+        self._latex = latex
         self._bindings = new_bindings
+        if changed:
+            self._version += 1
+            _remeasure(self)
         return self
 
     def unbind(self, *args):
@@ -45,62 +879,130 @@ class Expr:
         If no args: restore all placeholders (full unbind).
         If args provided: only restore those specific variables.
         """
-        if not args:
-            # Full unbind - restore original
-            return Expr(self._original)
-        
-        # Partial unbind - only restore specified variables
-        result = self.latex
-        new_bindings = dict(self._bindings)
-        for var in args:
-            if var in self._bindings:
-                # Replace the bound value back with param(var)
-                result = result.replace(str(self._bindings[var]), f"param({var})")
-                del new_bindings[var]
-        return Expr(result, self._original, new_bindings)
+        # Start over from the original and re-apply the remaining bindings
+        if self._original is None:
+            expr = Expr._from_tree(self._original_tree)
+        else:
+            expr = Expr(self._original)
+            if self._original_tree is not None:
+                expr._tree = expr._original_tree = self._original_tree
+        remaining = {k: v for k, v in self._bindings.items() if args and k not in args}
+        return expr.bind(**remaining) if remaining else expr
 
     def __call__(self, **kwargs):
         # If kwargs given, bind first
         expr = self.bind(**kwargs) if kwargs else self
-        clean = expr.latex
-        # Remove \text{...} for evaluation
-        while "\\text{" in clean:
-            start = clean.find("\\text{")
-            depth, end = 1, start + 6
-            while depth > 0 and end < len(clean):
-                if clean[end] == "{":
-                    depth += 1
-                elif clean[end] == "}":
-                    depth -= 1
-                end += 1
-            clean = clean[:start] + clean[end:]
-        # Replace unbound param(var) with just var (as a symbol)
-        clean = re.sub(r"param\((\w+)\)", r"\1", clean)
-        # Find last = and take everything after
-        eq_idx = clean.rfind("=")
-        if eq_idx != -1:
-            clean = clean[eq_idx + 1 :]
-        clean = clean.strip()
-        if not clean:
-            return 0
-        try:
-            return parse_latex(clean).evalf()
-        except:
-            return clean
+        if np is not None and expr._latex is not None and "\\begin{" in expr._latex:
+            clean = _evaluable_part(expr.latex)
+            if _MATRIX_RE.search(clean):
+                result = _timed("evaluate", lambda: _evaluate_matrix(clean), latex=expr.latex)
+                if result is not None:
+                    return result
+        tree = expr._sympy()
+        if tree is _Unparseable:
+            # Return the cleaned LaTeX with param(var) as var
+            return _PARAM_RE.sub(r"\1", _evaluable_part(expr.latex))
+
+        def evaluate():
+            # Hand the exception back so only evaluation errors, not hook errors, are caught
+            try:
+                return _unbound_as_symbols(tree).evalf()
+            except Exception as e:
+                return e
+
+        result = _timed("evaluate", evaluate, latex=lambda: expr.latex)
+        if isinstance(result, Exception):
+            _emit_error(result, latex=lambda: expr.latex)
+            return _PARAM_RE.sub(r"\1", _evaluable_part(expr.latex))
+        return result
 
     def solve(self, var_name):
-        clean = self.latex
-        eq_idx = clean.rfind("=")
-        if eq_idx != -1:
-            clean = clean[eq_idx + 1 :]
         try:
+            tree = self._sympy()
+            if tree is _Unparseable:
+                raise ValueError(f"can't parse {_evaluable_part(self.latex)}")
             var = Symbol(var_name)
-            sols = solve(parse_latex(clean.strip()), var)
+            sols = _timed("solve", lambda: solve(_unbound_as_symbols(tree), var), latex=lambda: self.latex, var=var_name)
             return f"{var_name} = " + ", ".join(str(s) for s in sols)
         except Exception as e:
+            _emit_error(e, latex=lambda: self.latex, var=var_name)
             return f"[Error: {e}]"
 
 
+def _equation(eq):
+    """Turn an Expr or LaTeX equation into a SymPy expression equal to 0"""
+    if isinstance(eq, Expr) and (eq._latex is None or "=" not in _strip_text(eq._latex)):
+        # Reuse the cached tree
+        tree = eq._sympy()
+        if tree is _Unparseable:
+            raise ValueError(f"can't parse {eq}")
+        return _unbound_as_symbols(tree)
+    sides = _strip_text(str(eq)).split("=")
+    trees = [_parse(side) for side in sides[-2:]]
+    if any(tree is None for tree in trees):
+        raise ValueError(f"can't parse {eq}")
+    tree = trees[0] - trees[1] if len(trees) == 2 else trees[0]
+    return _unbound_as_symbols(tree)
+
+
+def _latex_value(value):
+    return fmt(value) if value.is_Float else sympy_latex(value)
+
+
+@lru_cache(maxsize=256)
+def _solve_system_cached(equations, variables):
+    try:
+        A, b = linear_eq_to_matrix(equations, variables)
+    except NonlinearError:
+        pass
+    else:
+        # Linear: LU decomposition for a unique solution, linsolve otherwise
+        if A.is_square and A.det() != 0:
+            return (tuple(A.LUsolve(b)),)
+        return tuple(tuple(sol) for sol in linsolve((A, b), variables))
+    try:
+        sols = tuple(tuple(sol) for sol in nonlinsolve(equations, variables))
+    except Exception:
+        sols = ()
+    if sols and not any(isinstance(v, Set) or set(variables) & v.free_symbols for sol in sols for v in sol):
+        return sols
+    # No closed form: root-finding needs every other symbol to have a value
+    unknown = set().union(*(eq.free_symbols for eq in equations)) - set(variables)
+    if unknown:
+        if sols and not any(isinstance(v, Set) for sol in sols for v in sol):
+            return sols
+        names = ", ".join(sorted(str(s) for s in unknown))
+        raise ValueError(f"no closed-form solution, and solving numerically needs values for {names}")
+    return (tuple(nsolve(list(equations), list(variables), [1] * len(variables))),)
+
+
+def solve_system(equations, variables):
+    """Solve a system of equations for the named variables.
+
+    equations are Expr objects or LaTeX strings (an equation without = is
+    taken as equal to 0). Linear systems are solved with matrix methods,
+    nonlinear ones with nonlinsolve or numerically. Returns the solutions as
+    a LaTeX aligned environment, ready for ReplaceAll.
+    """
+    info = {"latex": ", ".join(str(eq) for eq in equations), "var": ", ".join(variables)}
+    try:
+        exprs = tuple(_equation(eq) for eq in equations)
+        syms = tuple(Symbol(v) for v in variables)
+        sols = _timed("solve", lambda: _solve_system_cached(exprs, syms), **info)
+    except Exception as e:
+        _emit_error(e, **info)
+        return f"[Error: {e}]"
+    if not sols:
+        return "\\text{no solution}"
+    if len(sols) == 1:
+        # One row per variable
+        rows = [f"{v} &= {_latex_value(x)}" for v, x in zip(variables, sols[0])]
+    else:
+        # One row per solution
+        rows = [" & ".join(f"{v} &= {_latex_value(x)}" for v, x in zip(variables, sol)) for sol in sols]
+    return "\\begin{aligned} " + " \\\\ ".join(rows) + " \\end{aligned}"
+
+
 class ReplaceThis:
     """Marker to replace just py(...) with value"""
 
@@ -194,18 +1096,149 @@ def get_this_latex(block_content, py_start, py_end):
     return get_latex_after(block_content, py_end)
 
 
+def _content_hash(content):
+    return hashlib.sha256(content.encode("utf-8")).hexdigest()
+
+
+def _file_hash(path):
+    try:
+        return _content_hash(path.read_text(encoding="utf-8"))
+    except OSError:
+        return None
+
+
+def include(path, *names):
+    """Import stored expressions from another Markdown file.
+
+    The file is processed once and its exported store entries are cached
+    (already parsed), so later includes of the same file from any document
+    in the same process skip re-evaluation until it or a file it includes
+    changes. If names are given, only those entries are injected into the
+    current store.
+    """
+    path = Path(path)
+    if not path.is_absolute():
+        base = _base_dirs[-1] if _base_dirs else Path.cwd()
+        path = Path(base) / path
+    path = path.resolve()
+    if path in _including:
+        raise ImportError(f"Circular include of {path.name}")
+
+    entry = _include_cache.get(path)
+    if entry is not None and all(_file_hash(f) == h for f, h in entry[0]):
+        _include_cache.move_to_end(path)
+        files, exported = entry
+    else:
+        content = path.read_text(encoding="utf-8")
+        # Process the file against its own empty store
+        global store
+        outer, store = store, Store(max_bytes=store.max_bytes)
+        _including.add(path)
+        _include_files.append({(path, _content_hash(content))})
+        try:
+            process_markdown(content, base_dir=path.parent)
+            exported = dict(store)
+        finally:
+            _including.discard(path)
+            files = tuple(sorted(_include_files.pop()))
+            store = outer
+        # Parse now so every document's copy shares the parsed tree
+        for value in exported.values():
+            if isinstance(value, Expr):
+                value._sympy()
+        _include_cache[path] = (files, exported)
+        if len(_include_cache) > _INCLUDE_CACHE_SIZE:
+            _include_cache.popitem(last=False)
+    if _include_files:
+        _include_files[-1].update(files)
+
+    for name in names:
+        if name not in exported:
+            raise NameError(f"'{name}' is not defined in {path.name}")
+    # Copy entries so in-place bind() calls don't leak between documents
+    for k in names or exported:
+        store[k] = copy.copy(exported[k])
+    return NoOutput
+
+
+# Names available in every py(...) block, shadowed by stored names
+_HELPERS = {
+    "ReplaceThis": ReplaceThis,
+    "ReplaceAll": ReplaceAll,
+    "solve_system": solve_system,
+    "include": include,
+    "use": include,
+}
+
+
+# Results of side-effect-free py(...) code in the current document
+_memo = {}
+_memo_stats = {"hits": 0, "misses": 0}
+# Stored value types whose state is fully captured by store and Expr versions
+_MEMO_SAFE_TYPES = (Expr, Basic, str, int, float, complex, bool, type(None))
+# Result types that can't be changed in place, so handing one out twice is safe
+_MEMO_RESULT_TYPES = (Basic, str, int, float, complex, bool, type(None), ReplaceThis, ReplaceAll, _NoOutput)
+_MISSING = object()
+
+
+def _memo_key(code, this_expr):
+    """Key identifying what code would compute, or None if it can't be memoized"""
+    names = _code_names(code)
+    if names is None or names[2] or names[0] & _OPAQUE_NAMES:
+        return None
+    state = []
+    for name in sorted(names[0]):
+        value = store.get(name, _MISSING)
+        if value is _MISSING:
+            continue
+        if not isinstance(value, _MEMO_SAFE_TYPES):
+            return None
+        state.append((name, store.version(name), getattr(value, "_version", None)))
+    return code, this_expr, tuple(state)
+
+
+def memo_stats():
+    """Return py(...) memoization hits, misses and hit rate since the last reset"""
+    total = _memo_stats["hits"] + _memo_stats["misses"]
+    return dict(_memo_stats, hit_rate=_memo_stats["hits"] / total if total else 0.0)
+
+
+def reset_memo_stats():
+    _memo_stats["hits"] = _memo_stats["misses"] = 0
+
+
 def execute_py(code, this_expr):
-    """Execute Python code with THIS bound to this_expr"""
+    """Execute Python code with THIS bound to this_expr
+
+    Code without assignments is memoized on its text, THIS and the versions
+    of the stored values it reads, so repeating it in a document is free.
+    Only results that can't be changed in place are reused.
+    """
+    key = _memo_key(code, this_expr)
+    if key is not None:
+        result = _memo.get(key, _MISSING)
+        if result is not _MISSING:
+            _memo_stats["hits"] += 1
+            if _hooks:
+                _emit("memo_hit", code=code)
+            return result
+        _memo_stats["misses"] += 1
+        if _hooks:
+            _emit("memo_miss", code=code)
+
+    result = _execute_py(code, this_expr)
+    # Only reuse the result if running the code left what it read unchanged
+    if key is not None and isinstance(result, _MEMO_RESULT_TYPES) and _memo_key(code, this_expr) == key:
+        _memo[key] = result
+    return result
+
+
+def _execute_py(code, this_expr):
     THIS = Expr(this_expr) if this_expr else Expr("")
 
-    local_vars = {
-        "THIS": THIS,
-        "ReplaceThis": ReplaceThis,
-        "ReplaceAll": ReplaceAll,
-    }
-    # Add stored expressions
-    for k, v in store.items():
-        local_vars[k] = v
+    # Layered view over the store and helpers: lookups fall through in order
+    # and assignments go straight to the store, so nothing is copied
+    local_vars = ChainMap(store, {"THIS": THIS}, _HELPERS)
 
     result = None
     # Split by ; and execute each statement
@@ -241,48 +1274,55 @@ def execute_py(code, this_expr):
         stmt = stmt.strip()
         if not stmt:
             continue
+        result = _timed("statement", lambda: _execute_statement(stmt, local_vars), statement=stmt)
 
-        # Check for assignment: name = value
-        eq_pos = -1
-        depth = 0
-        in_str = None
-        for i, c in enumerate(stmt):
-            if in_str:
-                if c == in_str and (i == 0 or stmt[i - 1] != "\\"):
-                    in_str = None
-            elif c in "\"'":
-                in_str = c
-            elif c == "(":
-                depth += 1
-            elif c == ")":
-                depth -= 1
-            elif c == "=" and depth == 0 and i > 0 and stmt[i - 1] != "!" and stmt[i - 1] != "=" and stmt[i - 1] != "<" and stmt[i - 1] != ">":
-                if i + 1 < len(stmt) and stmt[i + 1] == "=":
-                    continue
-                eq_pos = i
-                break
+    return result
 
-        if eq_pos > 0:
-            name = stmt[:eq_pos].strip()
-            value_code = stmt[eq_pos + 1 :].strip()
 
-            if name.isidentifier():
-                try:
-                    value = eval(value_code, {"__builtins__": __builtins__}, local_vars)
-                    local_vars[name] = value
-                    store[name] = value
-                    result = NoOutput  # Assignment - no output
-                except Exception as e:
-                    result = f"[Error: {e}]"
+def _execute_statement(stmt, local_vars):
+    """Execute one statement of a py(...) block and return its result"""
+    # Check for assignment: name = value
+    eq_pos = -1
+    depth = 0
+    in_str = None
+    for i, c in enumerate(stmt):
+        if in_str:
+            if c == in_str and (i == 0 or stmt[i - 1] != "\\"):
+                in_str = None
+        elif c in "\"'":
+            in_str = c
+        elif c == "(":
+            depth += 1
+        elif c == ")":
+            depth -= 1
+        elif c == "=" and depth == 0 and i > 0 and stmt[i - 1] != "!" and stmt[i - 1] != "=" and stmt[i - 1] != "<" and stmt[i - 1] != ">":
+            if i + 1 < len(stmt) and stmt[i + 1] == "=":
                 continue
+            eq_pos = i
+            break
 
-        # Just evaluate
-        try:
-            result = eval(stmt, {"__builtins__": __builtins__}, local_vars)
-        except Exception as e:
-            result = f"[Error: {e}]"
+    if eq_pos > 0:
+        name = stmt[:eq_pos].strip()
+        value_code = stmt[eq_pos + 1 :].strip()
+
+        if name.isidentifier():
+            try:
+                value = eval(value_code, {"__builtins__": __builtins__}, local_vars)
+                local_vars[name] = value
+                return NoOutput  # Assignment - no output
+            except Exception as e:
+                return _error_result(stmt, e)
+
+    # Just evaluate
+    try:
+        return eval(stmt, {"__builtins__": __builtins__}, local_vars)
+    except Exception as e:
+        return _error_result(stmt, e)
 
-    return result
+
+def _error_result(stmt, e):
+    _emit_error(e, statement=stmt)
+    return f"[Error: {e}]"
 
 
 def process_block(content):
@@ -337,47 +1377,274 @@ def process_block(content):
     return result.strip() if result.strip() != content.strip() else None
 
 
-def process_markdown(text):
-    """Process entire markdown file"""
-    result = []
+# Names whose use makes a block's effect on the store impossible to predict
+_OPAQUE_NAMES = {"include", "use", "eval", "exec", "globals", "locals", "vars"}
+# Stored values that can't be changed in place, so sharing them is harmless
+_IMMUTABLE_TYPES = (Basic, str, int, float, complex, bool, type(None), tuple, frozenset)
+# Names that aren't store entries, so calling them changes nothing stored
+_UNSTORED_NAMES = {"THIS"} | set(_HELPERS) | set(dir(builtins))
+
+
+@lru_cache(maxsize=4096)
+def _code_names(code):
+    """Find the names a piece of py(...) code reads and writes.
+
+    Returns (reads, writes, assigns, aliases), where assigns tells whether
+    the code contains an assignment and aliases holds, per assignment, the
+    stored names that may end up sharing one object (x = y, x = y.bind(...)),
+    or None if the code doesn't parse. Calling a method on a name
+    (x.bind(...)) or calling it with arguments (x(a=1)) may change it in
+    place, so that name counts as written too.
+    """
+    try:
+        tree = ast.parse(code)
+    except SyntaxError:
+        return None
+    reads, writes = set(), set()
+    assigns = False
+    aliases = []
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Name):
+            (writes if isinstance(node.ctx, ast.Store) else reads).add(node.id)
+        elif isinstance(node, ast.Call):
+            func = node.func
+            if isinstance(func, ast.Attribute) and isinstance(func.value, ast.Name):
+                writes.add(func.value.id)
+            elif isinstance(func, ast.Name) and (node.args or node.keywords) and func.id not in _UNSTORED_NAMES:
+                writes.add(func.id)
+        if isinstance(node, (ast.Assign, ast.AugAssign, ast.AnnAssign, ast.NamedExpr, ast.Delete)):
+            assigns = True
+            group = {n.id for n in ast.walk(node) if isinstance(n, ast.Name)} - _UNSTORED_NAMES
+            if len(group) > 1:
+                aliases.append(frozenset(group))
+    return frozenset(reads), frozenset(writes), assigns, tuple(aliases)
+
+
+def _block_names(content):
+    """Find the store names the py(...) code in a block reads and writes.
+
+    Returns (reads, writes, aliases) as for _code_names, or None if the
+    block can't be analyzed and has to be treated as depending on everything
+    around it.
+    """
+    reads, writes = set(), set()
+    aliases = []
+    offset = 0
+    while True:
+        block = find_py_block(content, offset)
+        if not block:
+            break
+        offset = block[1]
+        names = _code_names(block[2])
+        if names is None:
+            return None
+        reads |= names[0]
+        writes |= names[1]
+        aliases.extend(names[3])
+    if reads & _OPAQUE_NAMES:
+        return None
+    return reads, writes, aliases
+
+
+def _schedule(contents):
+    """Group blocks into levels that can each run concurrently.
+
+    A block lands in a later level than every earlier block it shares a
+    written name with, so running the levels in order gives the same store
+    contents as running the blocks one after another. Names that may share
+    an object (already in the store, or through an assignment anywhere in
+    the document) count as one: touching one touches them all. Each level
+    entry is (index, names), where names is None for a block that must run
+    on its own or the (reads, writes) of the block with aliases expanded.
+    """
+    analyzed = [_block_names(content) if "py(" in content else False for content in contents]
+
+    # Union names that may refer to the same object
+    parent = {}
+
+    def find(name):
+        while parent.get(name, name) != name:
+            name = parent[name]
+        return name
+
+    def union(names):
+        roots = [find(name) for name in names]
+        for root in roots:
+            parent[root] = roots[0]
+
+    by_id = {}
+    for name, value in dict.items(store):
+        if not isinstance(value, _IMMUTABLE_TYPES):
+            by_id.setdefault(id(value), []).append(name)
+    groups = [names for names in by_id.values() if len(names) > 1]
+    groups += [group for names in analyzed if names for group in names[2]]
+    for group in groups:
+        union(group)
+    members = {}
+    for name in list(parent):
+        members.setdefault(find(name), set()).add(name)
+
+    def expand(names):
+        return set().union(*(members.get(find(name), {name}) for name in names))
+
+    levels = []
+    written_at, read_at = {}, {}
+    floor = 0
+    for idx, names in enumerate(analyzed):
+        if names is False:
+            continue
+        if names is None:
+            level = len(levels)
+            floor = level + 1
+        else:
+            reads, writes = expand(names[0]), expand(names[1])
+            names = reads, writes
+            level = floor
+            for name in reads:
+                level = max(level, written_at.get(name, -1) + 1)
+            for name in writes:
+                level = max(level, written_at.get(name, -1) + 1, read_at.get(name, -1) + 1)
+            for name in reads:
+                read_at[name] = max(read_at.get(name, -1), level)
+            for name in writes:
+                written_at[name] = level
+        while len(levels) <= level:
+            levels.append([])
+        levels[level].append((idx, names))
+    return levels
+
+
+def _run_block(idx, content):
+    """Process the idx-th block of a document, reporting it to hooks"""
+    if not _hooks:
+        return process_block(content)
+    _emit("block_start", block=idx, content=content)
+    with _Timed("block_end", block=idx, content=content):
+        return process_block(content)
+
+
+def _process_block_isolated(content, env, writes):
+    """Process a block in a worker process against a copy of the store it needs"""
+    start = perf_counter()
+    store.clear()
+    store.update(env)
+    processed = process_block(content)
+    updates = {k: v for k, v in store.items() if k in writes or env.get(k) is not v}
+    return processed, updates, perf_counter() - start
+
+
+def _process_blocks(contents, jobs=None):
+    """Process the contents of every math block, in document order.
+
+    With jobs > 1, blocks that don't depend on each other through the store
+    are processed concurrently on a pool of jobs worker processes. Stored
+    values are exchanged by copy, together with every name that may share
+    an object with them. Hooks only see the block_start and block_end
+    events of blocks run on a worker.
+    """
+    if not jobs or jobs <= 1:
+        return [_run_block(idx, content) for idx, content in enumerate(contents)]
+
+    results = [None] * len(contents)
+    pool = None
+    try:
+        for level in _schedule(contents):
+            outcomes = None
+            if len(level) > 1 and pool is not False:
+                try:
+                    if pool is None:
+                        pool = ProcessPoolExecutor(max_workers=jobs)
+                    futures = []
+                    for idx, (reads, writes) in level:
+                        env = {k: store[k] for k in reads | writes if k in store}
+                        if _hooks:
+                            _emit("block_start", block=idx, content=contents[idx])
+                        futures.append((idx, pool.submit(_process_block_isolated, contents[idx], env, writes)))
+                    outcomes = [(idx, future.result()) for idx, future in futures]
+                except BrokenProcessPool:
+                    # A worker died and the pool can't be used again: finish
+                    # the document in this process
+                    pool.shutdown()
+                    pool = False
+                except Exception:
+                    # Something couldn't be sent to or from a worker (e.g. a
+                    # stored module can't be pickled): run the level here
+                    pass
+            if outcomes is None:
+                for idx, _ in level:
+                    results[idx] = _run_block(idx, contents[idx])
+                continue
+            for idx, (processed, updates, duration) in outcomes:
+                results[idx] = processed
+                store.update(updates)
+                if _hooks:
+                    _emit("block_end", block=idx, content=contents[idx], duration=duration)
+    finally:
+        if pool:
+            pool.shutdown()
+    return results
+
+
+def _split_markdown(text):
+    """Split text into (delimiter, content) segments.
+
+    delimiter is "$$" or "$" for math blocks and "" for plain text.
+    """
+    segments = []
+    plain_start = 0
     i = 0
 
     while i < len(text):
-        # Check for $$ (display math)
-        if text[i : i + 2] == "$$":
-            end = text.find("$$", i + 2)
-            if end == -1:
-                result.append(text[i:])
-                break
-            content = text[i + 2 : end]
-            processed = process_block(content)
-            if processed == "__DELETE__":
-                pass  # Delete the block entirely
-            elif processed is not None:
-                result.append("$$" + processed + "$$")
-            else:
-                result.append(text[i : end + 2])
-            i = end + 2
-        # Check for $ (inline math)
-        elif text[i] == "$":
-            end = text.find("$", i + 1)
+        # Check for $$ (display math), then $ (inline math)
+        if text[i] == "$":
+            delim = "$$" if text[i : i + 2] == "$$" else "$"
+            end = text.find(delim, i + len(delim))
             if end == -1:
-                result.append(text[i:])
                 break
-            content = text[i + 1 : end]
-            processed = process_block(content)
-            if processed == "__DELETE__":
-                pass  # Delete the block entirely
-            elif processed is not None:
-                result.append("$" + processed + "$")
-            else:
-                result.append(text[i : end + 1])
-            i = end + 1
+            if plain_start < i:
+                segments.append(("", text[plain_start:i]))
+            segments.append((delim, text[i + len(delim) : end]))
+            i = end + len(delim)
+            plain_start = i
         else:
-            result.append(text[i])
             i += 1
 
-    return "".join(result)
+    if plain_start < len(text):
+        segments.append(("", text[plain_start:]))
+    return segments
+
+
+def process_markdown(text, base_dir=None, jobs=None):
+    """Process entire markdown file
+
+    base_dir is the directory that include() paths are resolved against.
+    jobs > 1 processes independent blocks concurrently on that many worker
+    processes; the output is the same as processing them in order.
+    """
+    if base_dir is not None:
+        _base_dirs.append(Path(base_dir))
+    store.begin_document()
+    if not _including:
+        _memo.clear()
+    try:
+        segments = _split_markdown(text)
+        processed = iter(_process_blocks([content for delim, content in segments if delim], jobs))
+        result = []
+        for delim, content in segments:
+            if not delim:
+                result.append(content)
+                continue
+            block = next(processed)
+            if block == "__DELETE__":
+                pass  # Delete the block entirely
+            elif block is not None:
+                result.append(delim + block + delim)
+            else:
+                result.append(delim + content + delim)
+        return "".join(result)
+    finally:
+        if base_dir is not None:
+            _base_dirs.pop()
 
 
 def fmt(v):
@@ -2,11 +2,15 @@
 Pytest tests for markdown-math-solver
 """
 
+import copy
+import json
+import pickle
 import pytest
 import sys
 from pathlib import Path
 from markdown_math_solver import (
     Expr,
+    Store,
     ReplaceThis,
     ReplaceAll,
     find_py_block,
@@ -15,8 +19,15 @@ from markdown_math_solver import (
     process_block,
     process_markdown,
     store,
+    include,
+    solve_system,
+    memo_stats,
+    reset_memo_stats,
+    add_hook,
+    remove_hook,
+    MetricsCollector,
 )
-from markdown_math_solver.solver import _NoOutput
+from markdown_math_solver.solver import _NoOutput, _include_cache, _block_names, _schedule
 
 
 class TestExpr:
@@ -108,6 +119,210 @@ class TestExpr:
         e = Expr("x = 5 + 3")
         assert float(e()) == 8.0
 
+    def test_call_unparseable_returns_clean_latex(self):
+        e = Expr(r"\text{a}\frac{param(x)}")
+        assert e() == r"\frac{x}"
+
+    def test_add_expr_returns_expr(self):
+        total = Expr("1+2") + Expr(r"\frac{1}{2}")
+        assert isinstance(total, Expr)
+        assert float(total()) == 3.5
+
+    def test_arithmetic_with_numbers(self):
+        e = Expr("3")
+        assert float((2 * e - 1)()) == 5.0
+        assert float((e / 2)()) == 1.5
+        assert float((e**2)()) == 9.0
+        assert float((-e)()) == -3.0
+
+    def test_composed_latex_is_rendered_lazily(self):
+        total = Expr("x") * Expr("y")
+        assert total._latex is None
+        assert str(total) == "x y"
+
+    def test_bind_with_expr_value(self):
+        e = Expr("param(a) \\cdot 2")
+        e.bind(a=Expr("1+2"))
+        assert str(e) == r"\left(1+2\right) \cdot 2"
+        assert float(e()) == 6.0
+
+    @pytest.mark.parametrize(
+        "latex, value",
+        [(r"param(a) \cdot 2", "2+1"), ("param(a)^2", -3), (r"param(a) \cdot 2", Expr("1+2"))],
+    )
+    def test_bind_display_matches_value(self, latex, value):
+        fresh = Expr(latex)
+        fresh.bind(a=value)
+        cached = Expr(latex)
+        cached()
+        cached.bind(a=value)
+        assert fresh() == cached() == Expr(str(fresh))() == Expr(str(cached))()
+
+    @pytest.mark.parametrize(
+        "latex, value, expected",
+        [(r"k param(a)", -2, "-2 k"), (r"2 \pi param(r)", -3, r"-6 \pi"), (r"\pi param(r)^2", "x+1", r"\pi \cdot (x+1)^2")],
+    )
+    def test_bind_after_symbol(self, latex, value, expected):
+        assert Expr(latex).bind(a=value, r=value)() == Expr(expected)()
+
+    def test_bind_keeps_plain_text(self):
+        assert str(Expr(r"\frac{param(a)}{param(b)}").bind(a=-3, b=4)) == r"\frac{-3}{4}"
+        assert str(Expr("param(a) + 1").bind(a="x+1")) == "x+1 + 1"
+
+    def test_bind_does_not_reparse(self, monkeypatch):
+        from markdown_math_solver import solver
+
+        calls = []
+        original = solver.parse_latex
+        monkeypatch.setattr(solver, "parse_latex", lambda s: calls.append(s) or original(s))
+        e = Expr("param(a)")
+        for _ in range(8):
+            e = Expr("param(a) + 1").bind(a=e)
+        assert float(e(a=0)) == 8.0
+        assert len(calls) == 9
+        assert "\\left" not in str(e)
+
+    def test_partial_unbind_composed(self):
+        e = (Expr("param(a)") * Expr("param(b)")).bind(a=3, b=Expr("x+1"))
+        assert e.unbind("a")(a=2) == Expr("2 (x+1)")()
+        assert e.unbind("b")(b=2) == Expr("6")()
+        assert str(e.unbind()) == "param(a) param(b)"
+
+    def test_partial_unbind_text(self):
+        e = Expr(r"k param(a) + param(b)").bind(a=-2, b=3)
+        assert str(e.unbind("a")) == "k param(a) + 3"
+        assert str(e.unbind()) == "k param(a) + param(b)"
+
+    def test_neg_unparseable_falls_back_to_text(self):
+        assert -Expr(r"\frac{param(x)}") == r"-\frac{param(x)}"
+
+    def test_bind_composed_expr(self):
+        total = Expr("param(a)") + Expr("param(b)")
+        assert float(total(a=1, b=2)) == 3.0
+        assert str(total.unbind()) == "param(a) + param(b)"
+
+    def test_multi_letter_param(self):
+        e = Expr("param(rate)^2")
+        assert float(e(rate=4)) == 16.0
+
+    def test_composition_does_not_reparse(self, monkeypatch):
+        from markdown_math_solver import solver
+
+        calls = []
+        original = solver.parse_latex
+        monkeypatch.setattr(solver, "parse_latex", lambda s: calls.append(s) or original(s))
+        e, two, x = Expr("param(x) + 1"), Expr("2"), Expr("param(x)")
+        for _ in range(5):
+            e = e * two + x
+        assert float(e(x=1)) == 95.0
+        assert len(calls) == 3
+
+
+class TestMatrix:
+    """Test NumPy evaluation of matrix environments"""
+
+    A = r"\begin{pmatrix} 1 & 2 \\ 3 & 4 \end{pmatrix}"
+
+    def setup_method(self):
+        pytest.importorskip("numpy")
+
+    def test_literal(self):
+        assert Expr(self.A)() == r"\begin{pmatrix} 1 & 2 \\ 3 & 4 \end{pmatrix}"
+
+    def test_product(self):
+        result = Expr(self.A + r" \begin{pmatrix} 1 \\ 1 \end{pmatrix}")()
+        assert result == r"\begin{pmatrix} 3 \\ 7 \end{pmatrix}"
+
+    def test_inverse_and_transpose(self):
+        assert Expr(self.A + "^{-1}")() == r"\begin{pmatrix} -2 & 1 \\ 1.5 & -0.5 \end{pmatrix}"
+        assert Expr(self.A + "^T")() == r"\begin{pmatrix} 1 & 3 \\ 2 & 4 \end{pmatrix}"
+
+    def test_inverse_times_matrix_is_identity(self):
+        assert Expr(self.A + "^{-1} " + self.A)() == r"\begin{pmatrix} 1 & 0 \\ 0 & 1 \end{pmatrix}"
+
+    def test_brace_less_inverse_binds_tightly(self):
+        identity = r" + \begin{pmatrix} 1 & 0 \\ 0 & 1 \end{pmatrix}"
+        result = Expr(self.A + "^-1" + identity)()
+        assert result == r"\begin{pmatrix} -1 & 1 \\ 1.5 & 0.5 \end{pmatrix}"
+
+    def test_tree_built_skips_latex(self):
+        expr = Expr("param(x) + 1") * 2
+        assert expr(x=1) == "4"
+        assert expr._latex is None
+
+    def test_scalar_results(self):
+        assert Expr(r"\det " + self.A)() == "-2"
+        assert Expr(r"\begin{vmatrix} 1 & 2 \\ 3 & 4 \end{vmatrix}")() == "-2"
+        assert Expr(r"\operatorname{tr} " + self.A)() == "5"
+
+    def test_scalar_arithmetic_and_fractions(self):
+        result = Expr(r"2 \begin{bmatrix} \frac{1}{2} & -1 \end{bmatrix} + \begin{bmatrix} 1 & 1 \end{bmatrix}")()
+        assert result == r"\begin{bmatrix} 2 & -1 \end{bmatrix}"
+
+    def test_bind_params(self):
+        e = Expr(r"\begin{pmatrix} param(a) & 1 \end{pmatrix}^T")
+        assert e(a=5) == r"\begin{pmatrix} 5 \\ 1 \end{pmatrix}"
+
+    def test_symbolic_falls_back(self):
+        assert Expr(r"\begin{pmatrix} a & 1 \end{pmatrix}")() == r"\begin{pmatrix} a & 1 \end{pmatrix}"
+
+    @pytest.mark.parametrize("suffix", [".", "\\", " + 1", " - 2"])
+    def test_unsupported_falls_back(self, suffix):
+        assert Expr(self.A + suffix)() == self.A + suffix
+
+    def test_singular(self):
+        assert Expr(r"\begin{pmatrix} 1 & 1 \\ 1 & 1 \end{pmatrix}^{-1}")() == "[Error: Singular matrix]"
+
+    def test_without_numpy(self, monkeypatch):
+        from markdown_math_solver import solver
+
+        monkeypatch.setattr(solver, "np", None)
+        assert Expr(self.A + "^T")() == self.A + "^T"
+
+
+class TestSolveSystem:
+    """Test solve_system"""
+
+    def test_linear(self):
+        result = solve_system(["2x + y = 5", "x - y = 1"], ["x", "y"])
+        assert result == r"\begin{aligned} x &= 2 \\ y &= 1 \end{aligned}"
+
+    def test_linear_underdetermined(self):
+        result = solve_system(["x + y = 1", "2x + 2y = 2"], ["x", "y"])
+        assert result == r"\begin{aligned} x &= 1 - y \\ y &= y \end{aligned}"
+
+    def test_no_solution(self):
+        assert solve_system(["x + y = 1", "x + y = 2"], ["x", "y"]) == r"\text{no solution}"
+
+    def test_nonlinear_multiple_solutions(self):
+        result = solve_system(["x^2 + y = 5", "x - y = 1"], ["x", "y"])
+        assert result == r"\begin{aligned} x &= -3 & y &= -4 \\ x &= 2 & y &= 1 \end{aligned}"
+
+    def test_numeric_fallback(self):
+        result = solve_system([r"\cos(x) = x"], ["x"])
+        assert result == r"\begin{aligned} x &= 0.739085 \end{aligned}"
+
+    def test_no_numeric_fallback_with_parameters(self):
+        result = solve_system([r"\sin(x) + x^3 = a"], ["x"])
+        assert result == "[Error: no closed-form solution, and solving numerically needs values for a]"
+
+    def test_symbolic_solution_with_parameters(self):
+        result = solve_system(["x + y = a", "x - y = 0"], ["x", "y"])
+        assert result == r"\begin{aligned} x &= \frac{a}{2} \\ y &= \frac{a}{2} \end{aligned}"
+
+    def test_expr_equations(self):
+        eq = Expr("x") + Expr("y") - 3
+        result = solve_system([eq, Expr("x - y = 1")], ["x", "y"])
+        assert result == r"\begin{aligned} x &= 2 \\ y &= 1 \end{aligned}"
+
+    def test_error(self):
+        assert solve_system([r"\frac{x}"], ["x"]).startswith("[Error:")
+
+    def test_in_markdown(self):
+        store.clear()
+        result = process_markdown(r"$$x + y = 3 py(a = THIS)$$ $$py(ReplaceAll(solve_system([a, 'x - y = 1'], ['x', 'y'])))$$")
+        assert result == r"$$x + y = 3$$ $$\begin{aligned} x &= 2 \\ y &= 1 \end{aligned}$$"
+
 
 class TestReplaceThis:
     """Test ReplaceThis class"""
@@ -133,6 +348,88 @@ class TestReplaceAll:
         assert r.value == "3.14"
 
 
+class TestStore:
+    """Test the size-accounting Store"""
+
+    def test_nbytes_tracks_entries(self):
+        s = Store()
+        s["a"] = Expr("1+2")
+        s["b"] = [1, 2, 3]
+        size = s.nbytes
+        assert size > 0
+        s["a"] = Expr("1")
+        del s["b"]
+        assert 0 < s.nbytes < size
+        s.clear()
+        assert s.nbytes == 0
+
+    def test_update_and_pop_keep_accounting(self):
+        s = Store({"a": "x" * 100})
+        s.update(b="y" * 100)
+        assert s.pop("a") == "x" * 100
+        assert s.pop("missing", None) is None
+        s.setdefault("c", "z")
+        assert sorted(s) == ["b", "c"]
+        assert s.nbytes == sum(sys.getsizeof(v) for v in s.values())
+
+    def test_copies_keep_accounting(self):
+        s = Store({"a": Expr("1+2"), "b": "x" * 100}, max_bytes=10**6)
+        for other in (pickle.loads(pickle.dumps(s)), copy.deepcopy(s), copy.copy(s), s.copy()):
+            assert isinstance(other, Store)
+            assert sorted(other) == ["a", "b"]
+            assert other.nbytes == s.nbytes
+            assert other.max_bytes == 10**6
+        s |= {"c": "z"}
+        assert isinstance(s, Store)
+        del s["c"]
+        assert sorted(s) == ["a", "b"]
+
+    def test_expr_remeasured_when_parsed_or_bound(self):
+        s = Store()
+        s["a"] = s["b"] = Expr(" + ".join(f"x_{{{i}}}" for i in range(50)))
+        s["f"] = Expr("param(a) + 1")
+        before = s.nbytes
+        s["a"]()
+        parsed = s.nbytes
+        assert parsed > before
+        s["f"].bind(a=s["a"])
+        assert s.nbytes > parsed
+        del s["a"], s["b"], s["f"]
+        assert s.nbytes == 0
+
+    def test_evicts_least_recently_used(self):
+        s = Store(max_bytes=10**9)
+        for name in "abcd":
+            s[name] = "x" * 1000
+        s.begin_document()
+        s["a"]
+        s.max_bytes = s.nbytes
+        s["e"] = "x" * 1000
+        assert sorted(s) == ["a", "c", "d", "e"]
+
+    def test_referenced_entries_are_not_evicted(self):
+        s = Store()
+        s["a"] = "x" * 1000
+        s["b"] = "x" * 1000
+        s.max_bytes = 1
+        s["c"] = "x" * 1000
+        assert sorted(s) == ["a", "b", "c"]
+        s.begin_document()
+        s["d"] = "x" * 1000
+        assert sorted(s) == ["d"]
+
+    def test_process_markdown_pins_current_document(self):
+        store.clear()
+        store["old"] = Expr("1")
+        store.max_bytes = 1
+        try:
+            result = process_markdown("$2 py(a = THIS)$ $py(ReplaceThis(a()))$")
+            assert result == "$2$ $2$"
+            assert sorted(store) == ["a"]
+        finally:
+            store.max_bytes = None
+
+
 class TestFindPyBlock:
     """Test find_py_block function"""
 
@@ -207,6 +504,84 @@ class TestExecutePy:
         result = execute_py("a = THIS; ReplaceThis(str(a))", "test")
         assert result.value == "test"
 
+    def test_store_shadows_helpers(self):
+        store["ReplaceThis"] = ReplaceAll
+        result = execute_py("ReplaceThis('x')", "")
+        assert isinstance(result, ReplaceAll)
+
+    def test_store_is_not_copied(self, monkeypatch):
+        for i in range(100):
+            store[f"v{i}"] = Expr(str(i))
+
+        def fail(*args):
+            raise AssertionError("store was iterated")
+
+        monkeypatch.setattr(Store, "__iter__", fail)
+        monkeypatch.setattr(Store, "items", fail)
+        monkeypatch.setattr(Store, "keys", fail)
+        result = execute_py("y = v7; ReplaceThis(str(y))", "")
+        assert result.value == "7"
+        assert store["y"] is store["v7"]
+
+
+class TestMemo:
+    """Test memoization of repeated py(...) code"""
+
+    def setup_method(self):
+        store.clear()
+        reset_memo_stats()
+
+    def test_repeated_block_hits(self):
+        doc = r"$\frac{param(a)}{2} py(f = THIS)$" + " $py(ReplaceThis(f(a=3)))$" * 2 + " $py(ReplaceThis(str(f)))$" * 3
+        assert process_markdown(doc) == r"$\frac{param(a)}{2}$ $1.5$ $1.5$" + r" $\frac{3}{2}$" * 3
+        # The first f(a=3) binds f in place, so its repeat runs again too;
+        # only the str(f) repeats are served from the memo
+        assert memo_stats()["hits"] == 2
+        assert memo_stats()["misses"] == 3
+        assert memo_stats()["hit_rate"] == 0.4
+
+    def test_assignment_invalidates(self):
+        doc = "$1 py(a = THIS)$ $py(ReplaceThis(a()))$ $2 py(a = THIS)$ $py(ReplaceThis(a()))$"
+        assert process_markdown(doc) == "$1$ $1$ $2$ $2$"
+        assert memo_stats()["hits"] == 0
+
+    def test_in_place_bind_invalidates(self):
+        store["f"] = Expr("param(x) + 1")
+        assert execute_py("ReplaceThis(str(f))", "").value == "param(x) + 1"
+        store["f"].bind(x=1)
+        assert execute_py("ReplaceThis(str(f))", "").value == "1 + 1"
+        assert memo_stats()["hits"] == 0
+
+    def test_mutable_result_not_shared(self):
+        store["f"] = Expr("param(x) + 1")
+        r = execute_py("f.unbind()", "")
+        r.bind(x=5)
+        assert str(execute_py("f.unbind()", "")) == "param(x) + 1"
+        assert memo_stats()["hits"] == 0
+
+    def test_this_is_part_of_key(self):
+        assert execute_py("THIS()", "1+1") == "2"
+        assert execute_py("THIS()", "2+2") == "4"
+        assert execute_py("THIS()", "2+2") == "4"
+        assert memo_stats()["hits"] == 1
+
+    def test_mutable_values_not_memoized(self):
+        store["xs"] = [1]
+        execute_py("ReplaceThis(len(xs))", "")
+        store["xs"].append(2)
+        assert execute_py("ReplaceThis(len(xs))", "").value == "2"
+        assert memo_stats()["misses"] == 0
+
+    def test_hook_events(self):
+        events = []
+        hook = add_hook(lambda event, info: events.append(event))
+        try:
+            process_markdown("$py(ReplaceThis(1))$ $py(ReplaceThis(1))$")
+        finally:
+            remove_hook(hook)
+        assert events.count("memo_miss") == 1
+        assert events.count("memo_hit") == 1
+
 
 class TestProcessBlock:
     """Test process_block function"""
@@ -271,6 +646,286 @@ class TestProcessMarkdown:
         assert result == "Text $1+1$ more text"
 
 
+class TestInclude:
+    """Test include/use of other Markdown files"""
+
+    def setup_method(self):
+        store.clear()
+        _include_cache.clear()
+
+    def test_include_all(self, tmp_path):
+        (tmp_path / "constants.md").write_text("$9.81 py(g = THIS)$ $8.314 py(R = THIS)$")
+        result = process_markdown('$py(include("constants.md"))$ $py(ReplaceThis(g()))$', base_dir=tmp_path)
+        assert result == " $9.81$"
+        assert str(store["R"]) == "8.314"
+
+    def test_use_selected_names(self, tmp_path):
+        (tmp_path / "constants.md").write_text("$9.81 py(g = THIS)$ $8.314 py(R = THIS)$")
+        process_markdown('$py(use("constants.md", "g"))$', base_dir=tmp_path)
+        assert "g" in store
+        assert "R" not in store
+
+    def test_included_file_does_not_see_current_store(self, tmp_path):
+        (tmp_path / "constants.md").write_text("$2 py(a = THIS)$")
+        store["b"] = Expr("3")
+        include(tmp_path / "constants.md")
+        assert set(store) == {"a", "b"}
+
+    def test_cached_until_changed(self, tmp_path):
+        path = tmp_path / "constants.md"
+        path.write_text("$2 py(a = THIS)$")
+        include(path)
+        cached = _include_cache[path.resolve()]
+        include(path)
+        assert _include_cache[path.resolve()] is cached
+        path.write_text("$3 py(a = THIS)$")
+        include(path)
+        assert str(store["a"]) == "3"
+
+    def test_same_text_different_directories(self, tmp_path):
+        for name, u in (("a", 1), ("b", 2)):
+            (tmp_path / name).mkdir()
+            (tmp_path / name / "units.md").write_text(f"${u} py(u = THIS)$")
+            (tmp_path / name / "constants.md").write_text('$py(include("units.md"))$')
+        include(tmp_path / "a" / "constants.md")
+        assert str(store["u"]) == "1"
+        include(tmp_path / "b" / "constants.md")
+        assert str(store["u"]) == "2"
+
+    def test_nested_change_invalidates(self, tmp_path):
+        (tmp_path / "units.md").write_text("$1 py(u = THIS)$")
+        (tmp_path / "constants.md").write_text('$py(include("units.md"))$')
+        include(tmp_path / "constants.md")
+        (tmp_path / "units.md").write_text("$5 py(u = THIS)$")
+        include(tmp_path / "constants.md")
+        assert str(store["u"]) == "5"
+
+    def test_cache_is_bounded(self, tmp_path, monkeypatch):
+        from markdown_math_solver import solver
+
+        monkeypatch.setattr(solver, "_INCLUDE_CACHE_SIZE", 2)
+        for i in range(4):
+            (tmp_path / f"{i}.md").write_text(f"${i} py(v{i} = THIS)$")
+            include(tmp_path / f"{i}.md")
+        assert list(_include_cache) == [(tmp_path / "2.md").resolve(), (tmp_path / "3.md").resolve()]
+
+    def test_parsed_once_across_documents(self, tmp_path, monkeypatch):
+        from markdown_math_solver import solver
+
+        (tmp_path / "constants.md").write_text("$9.81 py(g = THIS)$")
+        calls = []
+        original = solver.parse_latex
+        monkeypatch.setattr(solver, "parse_latex", lambda s: calls.append(s) or original(s))
+        for _ in range(3):
+            store.clear()
+            process_markdown('$py(include("constants.md"))$ $py(ReplaceThis(g()))$', base_dir=tmp_path)
+        assert len(calls) == 1
+
+    def test_copies_are_independent(self, tmp_path):
+        path = tmp_path / "constants.md"
+        path.write_text("$param(x) py(f = THIS)$")
+        include(path)
+        store["f"].bind(x=2)
+        include(path)
+        assert str(store["f"]) == "param(x)"
+
+    def test_missing_name(self, tmp_path):
+        (tmp_path / "constants.md").write_text("$2 py(a = THIS)$")
+        with pytest.raises(NameError):
+            include(tmp_path / "constants.md", "b")
+
+    def test_circular_include(self, tmp_path):
+        (tmp_path / "a.md").write_text('$py(include("a.md"))$ $1 py(x = THIS)$')
+        include(tmp_path / "a.md")
+        assert str(store["x"]) == "1"
+        result = process_markdown('$py(include("a.md"))$', base_dir=tmp_path)
+        assert result == ""
+
+
+class TestParallel:
+    """Test dependency analysis and parallel block processing"""
+
+    DOC = (
+        r"$\frac{param(a)}{param(b)} py(ratio = THIS)$ $x^2 py(sq = THIS)$ "
+        r"$py(ReplaceThis(ratio(a=1, b=4)))$ $py(ReplaceThis(sq.solve('x')))$ "
+        r"$py(half = ratio.unbind(); ReplaceThis(half(a=1, b=2)))$ "
+        r"$py(ReplaceAll(str(sq) + ' = ' + str(sq(x=3))))$ $1 + 1$ text $py(ReplaceThis(str(half)))$"
+    )
+
+    def setup_method(self):
+        store.clear()
+
+    def test_block_names(self):
+        assert _block_names("py(y = f(a=1) + g)") == ({"f", "g"}, {"y", "f"}, [{"y", "f", "g"}])
+        assert _block_names("py(ReplaceThis(str(r.bind(a=2))))") == ({"ReplaceThis", "str", "r"}, {"r"}, [])
+
+    def test_aliases_share_dependencies(self):
+        doc = r"$param(x) py(a = THIS)$ $py(b = a)$ $1 py(c = THIS)$ $py(a.bind(x=2))$ $py(ReplaceThis(str(b)))$"
+        serial = process_markdown(doc)
+        store.clear()
+        assert process_markdown(doc, jobs=2) == serial
+        assert store["a"] is store["b"]
+
+    def test_aliases_already_in_store(self):
+        store["a"] = store["b"] = Expr(r"param(x) + 1")
+        levels = _schedule(["$py(a.bind(x=2))$", "$py(ReplaceThis(str(b)))$"])
+        assert [[idx for idx, _ in level] for level in levels] == [[0], [1]]
+
+    def test_unpicklable_level_runs_inline(self):
+        doc = r"$py(m = __import__('math'))$ $py(ReplaceThis(m.pi))$ $py(ReplaceThis(m.e))$"
+        serial = process_markdown(doc)
+        store.clear()
+        assert process_markdown(doc, jobs=2) == serial
+
+    def test_broken_pool_continues_serially(self, monkeypatch):
+        from concurrent.futures import Future
+        from concurrent.futures.process import BrokenProcessPool
+        from markdown_math_solver import solver
+
+        pools = []
+
+        class BrokenPool:
+            def __init__(self, max_workers):
+                self.broken = False
+                pools.append(self)
+
+            def submit(self, fn, *args):
+                if self.broken:
+                    raise BrokenProcessPool("pool is broken")
+                self.broken = True
+                future = Future()
+                future.set_exception(BrokenProcessPool("a worker died"))
+                return future
+
+            def shutdown(self, wait=True):
+                pass
+
+        serial = process_markdown(self.DOC)
+        store.clear()
+        monkeypatch.setattr(solver, "ProcessPoolExecutor", BrokenPool)
+        assert process_markdown(self.DOC, jobs=2) == serial
+        assert len(pools) == 1
+
+    def test_block_names_opaque(self):
+        assert _block_names('py(include("c.md"))') is None
+        assert _block_names("py(x = )") is None
+
+    def test_schedule_independent_blocks_share_level(self):
+        levels = _schedule(["1 py(a = THIS)", "2 py(b = THIS)", "py(a)", "no code"])
+        assert [[idx for idx, _ in level] for level in levels] == [[0, 1], [2]]
+
+    def test_schedule_write_after_read(self):
+        levels = _schedule(["py(a)", "1 py(a = THIS)"])
+        assert [[idx for idx, _ in level] for level in levels] == [[0], [1]]
+
+    def test_schedule_opaque_block_is_barrier(self):
+        levels = _schedule(["1 py(a = THIS)", 'py(include("c.md"))', "2 py(b = THIS)"])
+        assert [[idx for idx, _ in level] for level in levels] == [[0], [1], [2]]
+
+    def test_parallel_matches_serial(self):
+        serial = process_markdown(self.DOC)
+        serial_store = {k: str(v) for k, v in store.items()}
+        store.clear()
+        parallel = process_markdown(self.DOC, jobs=2)
+        assert parallel == serial
+        assert {k: str(v) for k, v in store.items()} == serial_store
+
+
+class TestHooks:
+    """Test instrumentation hooks and MetricsCollector"""
+
+    def setup_method(self):
+        store.clear()
+        self.events = []
+        self.hook = add_hook(lambda event, info: self.events.append((event, info)))
+
+    def teardown_method(self):
+        remove_hook(self.hook)
+
+    def test_events(self):
+        process_markdown(r"$x^2 - 4 py(f = THIS)$ $py(ReplaceThis(f.solve('x')))$ $py(ReplaceThis(f(x=1)))$ $py(nope)$")
+        names = [event for event, _ in self.events]
+        assert names.count("block_start") == names.count("block_end") == 4
+        for event in ("statement", "parse", "solve", "evaluate", "error"):
+            assert event in names
+        error = next(info for event, info in self.events if event == "error")
+        assert error["statement"] == "nope"
+        assert "NameError" in error["error"]
+        block_end = next(info for event, info in self.events if event == "block_end")
+        assert block_end["block"] == 0
+        assert block_end["duration"] >= 0
+
+    def test_error_events(self):
+        Expr(r"\frac{").solve("x")
+        solve_system([r"x + y = 1", r"\frac{"], ["x", "y"])
+        errors = [info for event, info in self.events if event == "error"]
+        assert any(info["latex"] == r"\frac{" and "var" not in info for info in errors)
+        assert any(info.get("var") == "x" for info in errors)
+        assert any(info.get("var") == "x, y" for info in errors)
+        json.dumps(self.events)
+
+    def test_evaluate_error_event(self, monkeypatch):
+        from markdown_math_solver import solver
+
+        class Broken:
+            def evalf(self):
+                raise ValueError("cannot evaluate")
+
+        monkeypatch.setattr(solver, "_unbound_as_symbols", lambda tree: Broken())
+        assert Expr("param(x) + 1")() == "x + 1"
+        error = next(info for event, info in self.events if event == "error")
+        assert error == {"error": "ValueError: cannot evaluate", "latex": "param(x) + 1"}
+
+    def test_matrix_error_event(self):
+        pytest.importorskip("numpy")
+        Expr(r"\begin{pmatrix} 1 & 1 \\ 1 & 1 \end{pmatrix}^{-1}")()
+        error = next(info for event, info in self.events if event == "error")
+        assert "LinAlgError" in error["error"]
+
+    def test_hook_errors_propagate(self):
+        def failing(event, info):
+            raise RuntimeError("hook failed")
+
+        e = Expr("x + 1")
+        e._sympy()
+        add_hook(failing)
+        try:
+            with pytest.raises(RuntimeError):
+                Expr("x + 1")._sympy()
+            with pytest.raises(RuntimeError):
+                e()
+        finally:
+            remove_hook(failing)
+
+    def test_remove_hook(self):
+        remove_hook(self.hook)
+        process_markdown("$1 py(a = THIS)$")
+        assert self.events == []
+        self.hook = add_hook(lambda event, info: None)
+
+    def test_collector_snapshot(self):
+        collector = MetricsCollector(buckets=[0.5, 1.0])
+        collector("parse", {"duration": 0.2})
+        collector("parse", {"duration": 2.0})
+        collector("error", {"statement": "x"})
+        snap = collector.snapshot()
+        assert snap["counts"] == {"parse": 2, "error": 1}
+        assert snap["histograms"]["parse"]["buckets"] == [[0.5, 1], [1.0, 1], ["+Inf", 2]]
+        assert snap["histograms"]["parse"]["count"] == 2
+        assert snap["histograms"]["parse"]["sum"] == pytest.approx(2.2)
+
+    def test_collector_prometheus(self):
+        collector = add_hook(MetricsCollector())
+        try:
+            process_markdown("$1 py(a = THIS)$")
+        finally:
+            remove_hook(collector)
+        text = collector.to_prometheus()
+        assert 'markdown_math_solver_events_total{event="statement"} 1' in text
+        assert 'markdown_math_solver_duration_seconds_count{event="block_end"} 1' in text
+        assert 'markdown_math_solver_duration_seconds_bucket{event="block_end",le="+Inf"} 1' in text
+
+
 class TestFmt:
     """Test fmt formatting function"""
 